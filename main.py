@@ -1,14 +1,21 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, field_validator
 import os
+import re
+import shutil
 import uuid
-import glob
-from fastapi.responses import FileResponse
+from pathlib import PurePath
+from types import MappingProxyType
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
 import logging
 import asyncio
 import time
+import queue
+from collections import deque
 import yt_dlp
+from cachetools import TTLCache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -28,129 +35,426 @@ app.add_middleware(
 DOWNLOAD_DIR = "downloads"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
-# Rate limiting
-last_request_time = 0
-MIN_REQUEST_INTERVAL = 2  # 2 seconds between requests
+# Media type by audio file extension
+MEDIA_TYPES = MappingProxyType({
+    '.m4a': 'audio/mp4',
+    '.webm': 'audio/webm',
+    '.opus': 'audio/opus',
+    '.mp3': 'audio/mpeg',
+    '.wav': 'audio/wav',
+})
 
-class YouTubeDownloadRequest(BaseModel):
-    url: HttpUrl
+# Finished downloads are kept on disk and reused by video id
+CACHE_MAX_ENTRIES = 512
+CACHE_TTL = 3600  # seconds
+CACHE_SWEEP_INTERVAL = 300  # seconds between sweeps of evicted downloads
+_CACHE: TTLCache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL)
+# In-flight downloads by video id; concurrent requests for the same video await the same future
+_INFLIGHT: dict[str, asyncio.Future] = {}
+_sweep_task = None
 
-async def cleanup_file(file_path: str):
-    """Async function to clean up downloaded file"""
-    try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"Cleaned up file: {file_path}")
-    except Exception as e:
-        logger.error(f"Error cleaning up file {file_path}: {e}")
+# Offload file delivery to nginx via X-Accel-Redirect (see README for the nginx location)
+USE_X_ACCEL = os.getenv("USE_X_ACCEL", "false").lower() in ("1", "true", "yes")
+X_ACCEL_PREFIX = "/_internal_downloads/"
 
-@app.get("/health")
-async def health_check():
-    """Health check endpoint for monitoring"""
-    return {"status": "healthy", "service": "youtube-audio-downloader"}
+class TokenBucket:
+    """Async token bucket: allows bursts up to `capacity` and refills at `refill_rate` tokens/sec"""
 
-@app.post("/download")
-async def download_youtube_audio(request: YouTubeDownloadRequest):
-    global last_request_time
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    async def acquire(self, n: float = 1):
+        """Take `n` tokens, waiting for the bucket to refill if needed"""
+        async with self._lock:
+            self._refill()
+            # Re-check after every wait, a penalize() while asleep pushes the release back
+            while self.tokens < n:
+                await asyncio.sleep((n - self.tokens) / self.refill_rate)
+                self._refill()
+            self.tokens -= n
+
+    def penalize(self):
+        """Push the bucket into debt after upstream throttling so later requests queue behind it"""
+        self._refill()
+        self.tokens = min(-1, self.tokens - self.refill_rate)
+
+# Rate limiting: bursts of up to 5 downloads, then one every 2 seconds
+_BUCKET = TokenBucket(capacity=5, refill_rate=0.5)
+
+# Retries when YouTube flags the request as automated
+MAX_DOWNLOAD_ATTEMPTS = 3
+RETRY_BACKOFF_BASE = 2  # seconds, doubled on every attempt
+RETRY_BACKOFF_MAX = 30
+# Seconds to wait after each failed attempt, computed once: (4, 8) with the defaults above
+RETRY_BACKOFF_SCHEDULE = tuple(
+    min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt)
+    for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS)
+)
+BOT_DETECTION_KEYWORDS = ("bot", "429", "too many requests", "precondition check failed", "sign in to confirm")
+
+def _is_bot_detection(error_msg: str) -> bool:
+    """Whether a yt-dlp error means YouTube is throttling or blocking us"""
+    error_msg = error_msg.lower()
+    return any(keyword in error_msg for keyword in BOT_DETECTION_KEYWORDS)
+
+def _download_http_error(error_msg: str) -> HTTPException:
+    """Map a yt-dlp error message to the HTTP error returned to the client"""
+    # Check if it's an ffmpeg-related error
+    if "ffmpeg" in error_msg.lower() or "ffprobe" in error_msg.lower():
+        return HTTPException(
+            status_code=500, 
+            detail="Audio conversion failed. Please install ffmpeg: https://ffmpeg.org/download.html"
+        )
     
-    # Rate limiting
-    current_time = time.time()
-    time_since_last = current_time - last_request_time
-    if time_since_last < MIN_REQUEST_INTERVAL:
-        sleep_time = MIN_REQUEST_INTERVAL - time_since_last
-        await asyncio.sleep(sleep_time)
+    # Check for bot detection errors
+    if _is_bot_detection(error_msg):
+        return HTTPException(
+            status_code=429,
+            detail="YouTube is blocking automated requests. Please try again later or use a different video."
+        )
     
-    last_request_time = time.time()
+    # Check for SSL errors
+    if "ssl" in error_msg.lower() or "certificate" in error_msg.lower():
+        return HTTPException(
+            status_code=500,
+            detail="SSL certificate verification failed. Please try again later."
+        )
     
-    video_url = str(request.url)
-    file_id = str(uuid.uuid4())
-    output_template = f"{DOWNLOAD_DIR}/{file_id}.%(ext)s"
+    # Generic error
+    return HTTPException(
+        status_code=500, 
+        detail=f"Failed to download audio: {error_msg}"
+    )
 
-    logger.info(f"Starting download for URL: {video_url}")
+# Pool of persistent yt-dlp instances, kept alive (never closed) for the lifetime of the app
+# so extractor state and open HTTPS connections are reused across requests. Don't set
+# per-request network options like source_address, they force a fresh connection. Each
+# instance runs one download at a time, so the pool size bounds how many run in parallel
+MAX_CONCURRENT_DOWNLOADS = 4
+YDL_OPTIONS = {
+    'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio',
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+    'http_chunk_size': 1 << 20,  # 1MB ranged requests
+    'socket_timeout': 30,
+}
+
+def _create_ydl() -> yt_dlp.YoutubeDL:
+    """Create a YoutubeDL with the YouTube extractor preloaded so the first download does not pay for it"""
+    ydl = yt_dlp.YoutubeDL(dict(YDL_OPTIONS))
+    ydl.get_info_extractor('Youtube')
+    return ydl
 
-    # Simple yt-dlp options
-    options = {
-        'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio',
-        'outtmpl': output_template,
-        'noplaylist': True,
-        'quiet': True,
-        'no_warnings': True,
-    }
+_YDL_POOL: queue.Queue = queue.Queue()
+for _ in range(MAX_CONCURRENT_DOWNLOADS):
+    _YDL_POOL.put(_create_ydl())
 
+def _download_audio(video_url: str, output_template: str) -> dict:
+    """Blocking download on a pooled YoutubeDL instance; run it in a worker thread"""
+    ydl = _YDL_POOL.get()
     try:
-        # Use yt-dlp Python API
-        with yt_dlp.YoutubeDL(options) as ydl:
-            # Download the video
-            ydl.download([video_url])
+        ydl.params['outtmpl'] = {'default': output_template}
+        return ydl.extract_info(video_url, download=True)
+    finally:
+        _YDL_POOL.put(ydl)
 
-        # Find the generated file using glob pattern
-        downloaded_files = glob.glob(f"{DOWNLOAD_DIR}/{file_id}.*")
-        
-        if not downloaded_files:
-            raise HTTPException(status_code=500, detail="Audio file not found after download")
-        
-        file_path = downloaded_files[0]
-        file_size = os.path.getsize(file_path)
-        
-        logger.info(f"Download completed: {file_path} ({file_size} bytes)")
-        
-        # Determine media type based on file extension
-        file_ext = os.path.splitext(file_path)[1].lower()
-        media_types = {
-            '.m4a': 'audio/mp4',
-            '.webm': 'audio/webm',
-            '.opus': 'audio/opus',
-            '.mp3': 'audio/mpeg',
-            '.wav': 'audio/wav'
-        }
-        media_type = media_types.get(file_ext, 'audio/mpeg')
+# Streaming runs the yt-dlp CLI so its output can be piped straight to the client
+YTDLP_BIN = shutil.which("yt-dlp") or "yt-dlp"
+STREAM_ARGS: tuple[str, ...] = (
+    YTDLP_BIN,
+    "-f", "bestaudio[ext=m4a]",
+    "--no-playlist",
+    "--quiet",
+    "--no-warnings",
+    "--http-chunk-size", "1M",
+    "--socket-timeout", "30",
+    "-o", "-",
+)
+STREAM_CHUNK_SIZE = 1 << 20  # 1MB
+STDERR_TAIL_CHUNKS = 8  # keep the last ~8KB of yt-dlp's stderr for error reporting
+
+async def _tail_stream(stream: asyncio.StreamReader, tail: deque):
+    """Drain a subprocess pipe, keeping only its last few KB in `tail`"""
+    while chunk := await stream.read(1024):
+        tail.append(chunk)
+
+class ZeroCopyFileResponse(FileResponse):
+    """FileResponse that lets the server sendfile() the audio straight from disk when it
+    supports the ASGI zero-copy send extension, and streams it in chunks otherwise.
+
+    uvicorn does not implement the extension, so under the shipped Dockerfile and render.yaml
+    setup this always takes the regular FileResponse path. The zero-copy branch only runs on
+    servers that advertise http.response.zerocopysend, and has not been exercised yet"""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.send_header_only or "http.response.zerocopysend" not in scope.get("extensions", {}):
+            await super().__call__(scope, receive, send)
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        with open(self.path, "rb") as file:
+            await send({
+                "type": "http.response.zerocopysend",
+                "file": file,
+                "more_body": False,
+            })
+        if self.background is not None:
+            await self.background()
+
+# Matches watch, shorts and youtu.be links and captures the 11-character video id.
+# Scheme and host are case-insensitive, the video id is not
+_YOUTUBE_URL_RE = re.compile(
+    r"^(?:(?i:https?://(?:www\.|m\.|music\.)?youtube\.com)/(?:watch\?(?:.*&)?v=|shorts/)"
+    r"|(?i:https?://youtu\.be)/)"
+    r"([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])"
+)
+
+class YouTubeDownloadRequest(BaseModel):
+    url: str
+
+    @field_validator("url")
+    @classmethod
+    def validate_youtube_url(cls, url: str) -> str:
+        """Accept only YouTube video links and normalize them to the canonical watch URL"""
+        match = _YOUTUBE_URL_RE.match(url.strip())
+        if not match:
+            raise ValueError("URL must be a YouTube video link")
+        return f"https://www.youtube.com/watch?v={match.group(1)}"
+
+    @property
+    def video_id(self) -> str:
+        """The 11-character YouTube video id, taken from the normalized URL"""
+        return self.url[-11:]
+
+async def sweep_downloads():
+    """Periodically remove downloads that expired or were evicted from the cache"""
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+        try:
+            _CACHE.expire()
+            with os.scandir(DOWNLOAD_DIR) as entries:
+                for entry in entries:
+                    if entry.is_dir() and entry.name not in _CACHE and entry.name not in _INFLIGHT:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                        logger.info(f"Swept download: {entry.path}")
+        except Exception as e:
+            logger.error(f"Error sweeping downloads: {e}")
+
+@app.on_event("startup")
+async def start_sweeper():
+    global _sweep_task
+    _sweep_task = asyncio.create_task(sweep_downloads())
+
+async def _fetch_audio(video_id: str, video_url: str) -> tuple[str, os.stat_result]:
+    """Download the audio for a video into its own directory and cache it"""
+    # Each video gets its own directory so the top-level downloads dir stays small
+    # and cleanup is a single rmtree. The download itself goes to a private incoming
+    # directory inside it and is moved into place once complete, so a failed download
+    # only ever removes its own partial files. yt-dlp creates both when writing the file
+    video_dir = os.path.join(DOWNLOAD_DIR, video_id)
+    incoming_dir = os.path.join(video_dir, f".incoming-{uuid.uuid4().hex}")
+    output_template = f"{incoming_dir}/audio.%(ext)s"
+
+    logger.info(f"Starting download for URL: {video_url}")
+
+    try:
+        # Download on a pooled yt-dlp instance without blocking the event loop.
+        # Bot detection is retried after a backoff, queueing again on the penalized bucket
+        for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+            try:
+                info = await asyncio.to_thread(_download_audio, video_url, output_template)
+                break
+            except yt_dlp.utils.DownloadError as e:
+                if attempt == MAX_DOWNLOAD_ATTEMPTS or not _is_bot_detection(str(e)):
+                    raise
+                logger.warning(f"Bot detection on attempt {attempt} for URL {video_url}, retrying")
+                _BUCKET.penalize()
+                await asyncio.sleep(RETRY_BACKOFF_SCHEDULE[attempt - 1])
+                await _BUCKET.acquire()
+
+        # yt-dlp reports the final path of what it wrote, no need to scan the directory
+        requested_downloads = info.get('requested_downloads') or []
+        file_path = requested_downloads[0].get('filepath') if requested_downloads else None
         
-        # Return the file and clean it up after serving
-        return FileResponse(
-            file_path, 
-            media_type=media_type, 
-            filename=os.path.basename(file_path),
-            background=lambda: asyncio.create_task(cleanup_file(file_path))
-        )
+        if file_path:
+            # Publish the finished file; rename is atomic and replaces any stale copy
+            published_path = os.path.join(video_dir, os.path.basename(file_path))
+            os.replace(file_path, published_path)
+            file_path = published_path
+            file_stat = os.stat(file_path)
         
     except yt_dlp.utils.DownloadError as e:
+        shutil.rmtree(incoming_dir, ignore_errors=True)
         error_msg = str(e)
         logger.error(f"yt-dlp error for URL {video_url}: {error_msg}")
         
-        # Check if it's an ffmpeg-related error
-        if "ffmpeg" in error_msg.lower() or "ffprobe" in error_msg.lower():
-            raise HTTPException(
-                status_code=500, 
-                detail="Audio conversion failed. Please install ffmpeg: https://ffmpeg.org/download.html"
-            )
-        
-        # Check for bot detection errors
-        if any(keyword in error_msg.lower() for keyword in ["bot", "429", "too many requests", "precondition check failed", "sign in to confirm"]):
-            raise HTTPException(
-                status_code=429,
-                detail="YouTube is blocking automated requests. Please try again later or use a different video."
-            )
-        
-        # Check for SSL errors
-        if "ssl" in error_msg.lower() or "certificate" in error_msg.lower():
-            raise HTTPException(
-                status_code=500,
-                detail="SSL certificate verification failed. Please try again later."
-            )
-        
-        # Generic error
-        raise HTTPException(
-            status_code=500, 
-            detail=f"Failed to download audio: {error_msg}"
-        )
+        if _is_bot_detection(error_msg):
+            _BUCKET.penalize()
+        raise _download_http_error(error_msg)
         
     except Exception as e:
+        shutil.rmtree(incoming_dir, ignore_errors=True)
         logger.error(f"Unexpected error for URL {video_url}: {str(e)}")
         raise HTTPException(
             status_code=500, 
             detail=f"Unexpected error: {str(e)}"
         )
 
+    shutil.rmtree(incoming_dir, ignore_errors=True)
+    if not file_path:
+        raise HTTPException(status_code=500, detail="Audio file not found after download")
+    
+    logger.info(f"Download completed: {file_path} ({file_stat.st_size} bytes)")
+    _CACHE[video_id] = file_path
+    return file_path, file_stat
+
+def _audio_response(video_id: str, file_path: str, file_stat: os.stat_result) -> Response:
+    """Build the response that sends a downloaded audio file to the client"""
+    # Determine media type based on file extension
+    file_ext = PurePath(file_path).suffix.lower()
+    media_type = MEDIA_TYPES.get(file_ext, 'audio/mpeg')
+    filename = f"{video_id}{file_ext}"
+    
+    if USE_X_ACCEL:
+        # Let nginx serve the file
+        return Response(
+            status_code=200,
+            media_type=media_type,
+            headers={
+                "X-Accel-Redirect": f"{X_ACCEL_PREFIX}{video_id}/{os.path.basename(file_path)}",
+                "Content-Disposition": f'attachment; filename="{filename}"',
+            },
+        )
+    
+    # Files stay on disk while cached; sweep_downloads removes them once they expire or are evicted
+    return ZeroCopyFileResponse(
+        file_path, 
+        media_type=media_type, 
+        filename=filename,
+        stat_result=file_stat,
+    )
+
+@app.get("/health")
+async def health_check():
+    """Health check endpoint for monitoring"""
+    return {"status": "healthy", "service": "youtube-audio-downloader"}
+
+@app.post("/download")
+async def download_youtube_audio(request: YouTubeDownloadRequest):
+    video_id = request.video_id
+
+    # Serve repeat requests straight from disk without going to YouTube
+    file_path = _CACHE.get(video_id)
+    if file_path:
+        try:
+            return _audio_response(video_id, file_path, os.stat(file_path))
+        except FileNotFoundError:
+            _CACHE.pop(video_id, None)
+
+    # Someone is already downloading this video, wait for their result instead.
+    # Shielded so a follower disconnecting doesn't cancel the shared download
+    fut = _INFLIGHT.get(video_id)
+    if fut is not None:
+        file_path, file_stat = await asyncio.shield(fut)
+        return _audio_response(video_id, file_path, file_stat)
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[video_id] = fut
+    try:
+        # Rate limiting
+        await _BUCKET.acquire()
+        
+        file_path, file_stat = await _fetch_audio(video_id, request.url)
+        fut.set_result((file_path, file_stat))
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved, there may be no followers
+        raise
+    finally:
+        if not fut.done():
+            # The leader was cancelled; give followers a proper error rather than CancelledError
+            fut.set_exception(HTTPException(
+                status_code=503,
+                detail="Download was interrupted. Please try again."
+            ))
+            fut.exception()
+        del _INFLIGHT[video_id]
+    
+    return _audio_response(video_id, file_path, file_stat)
+
+@app.post("/stream")
+async def stream_youtube_audio(request: YouTubeDownloadRequest):
+    """Stream m4a audio to the client while yt-dlp is still downloading it"""
+    # Rate limiting
+    await _BUCKET.acquire()
+    
+    video_url = request.url
+    
+    logger.info(f"Starting stream for URL: {video_url}")
+    
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *STREAM_ARGS,
+            video_url,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=500, detail="yt-dlp executable not found")
+    
+    # Keep draining stderr so a chatty yt-dlp can never block on a full pipe
+    stderr_tail = deque(maxlen=STDERR_TAIL_CHUNKS)
+    stderr_task = asyncio.create_task(_tail_stream(proc.stderr, stderr_tail))
+    
+    # Wait for the first chunk so failures before any audio arrives still get a proper error
+    first_chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+    if not first_chunk:
+        await proc.wait()
+        await stderr_task
+        error_msg = b"".join(stderr_tail).decode("utf-8", "replace").strip()
+        logger.error(f"yt-dlp error for URL {video_url}: {error_msg}")
+        if _is_bot_detection(error_msg):
+            _BUCKET.penalize()
+        raise _download_http_error(error_msg)
+    
+    async def body():
+        try:
+            chunk = first_chunk
+            while chunk:
+                yield chunk
+                chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+            if await proc.wait() != 0:
+                await stderr_task
+                error_msg = b"".join(stderr_tail).decode("utf-8", "replace").strip()
+                logger.error(f"yt-dlp exited with code {proc.returncode} while streaming URL {video_url}: {error_msg}")
+        finally:
+            # Client went away mid-stream
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            await stderr_task
+    
+    return StreamingResponse(
+        body(),
+        media_type="audio/mp4",
+        headers={"Content-Disposition": f'attachment; filename="{request.video_id}.m4a"'},
+    )
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Single worker: the rate limiter, download cache and in-flight map live in this process
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", log_level="warning")
\ No newline at end of file